@@ -15,22 +15,113 @@ only accept the version numbers that module supports.
 
 import os
 import sys
+import errno
+import signal
 import optparse
 import shutil
 import stat
+import tarfile
+import hashlib
 import time
+import subprocess
+import multiprocessing
 
 from distutils.version import StrictVersion
 
 verbose = False
 stderr = sys.stderr
+hook_timeout = 60 # seconds each switch hook may run for before it is killed
+metrics_file = None # node_exporter textfile to write metrics to, if any
 
 
 class JungleError(Exception):
     """ An error in the jungle itself. JungleErrors are handled within the
     jungle invocation environment when run as a script. """
 
+def disk_usage(root):
+    """ Return the number of bytes of disk that removing root would free.
+    This counts the blocks allocated to the files below root, each inode once,
+    and leaves out files that are also hard linked from elsewhere. The
+    directories themselves are not counted. """
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            key = (st.st_dev, st.st_ino)
+            if key in inodes:
+                inodes[key][1] += 1
+            else:
+                inodes[key] = [st, 1]
+    total = 0
+    for st, links in inodes.values():
+        if links >= st.st_nlink:
+            total += st.st_blocks * 512
+    return total
+
+def archive_release(source, target, measure=False):
+    """ Stream the release directory source into the compressed tarball
+    target, then remove source. This is module level so it can be handed to a
+    multiprocessing pool. The tarball is written alongside and renamed into
+    place, so a half written archive is never visible. If measure is True the
+    number of bytes saved, if any, is returned. """
+    new = target + ".new"
+    tar = tarfile.open(new, "w|gz")
+    try:
+        tar.add(source, arcname=os.path.basename(source))
+    finally:
+        tar.close()
+    os.rename(new, target)
+    saved = 0
+    if measure:
+        # a small release can take more room compressed than it did before
+        saved = max(0, disk_usage(source) - os.stat(target).st_blocks * 512)
+    shutil.rmtree(source)
+    return saved
+
+def file_entry(args):
+    """ Return the manifest entry for the file relpath below root, as a
+    (relpath, size, mode, mtime, digest) tuple. Regular files are hashed, and
+    symlinks are hashed on their target. This is module level so it can be
+    handed to a multiprocessing pool. """
+    root, relpath = args
+    path = os.path.join(root, relpath)
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        digest = hashlib.sha256(os.readlink(path)).hexdigest()
+    elif stat.S_ISREG(st.st_mode):
+        h = hashlib.sha256()
+        f = open(path, "rb")
+        try:
+            while True:
+                block = f.read(65536)
+                if not block:
+                    break
+                h.update(block)
+        finally:
+            f.close()
+        digest = h.hexdigest()
+    else:
+        digest = "-"
+    return relpath, st.st_size, st.st_mode, int(st.st_mtime), digest
+
+def walk_release(root):
+    """ Return the path, relative to root, of everything below root. """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for name in dirnames + filenames:
+            if rel == ".":
+                paths.append(name)
+            else:
+                paths.append(os.path.join(rel, name))
+    return sorted(paths)
+
 class Jungle(object):
+
+    # the history is compacted down to history_keep entries once it grows
+    # beyond history_limit bytes
+    history_limit = 64 * 1024
+    history_keep = 100
     
     def __init__(self, parent):
         if not os.path.exists(parent):
@@ -41,6 +132,16 @@ class Jungle(object):
         self.release = os.path.join(self.parent, "release")
         self.current = os.path.join(self.parent, "current")
         self.current_new = os.path.join(self.parent, "current.new")
+        self.next = os.path.join(self.parent, "next")
+        self.next_new = os.path.join(self.parent, "next.new")
+        self.previous = os.path.join(self.parent, "previous")
+        self.previous_new = os.path.join(self.parent, "previous.new")
+        self.archive = os.path.join(self.parent, "archive")
+        self.history = os.path.join(self.parent, "history")
+        self.manifests = os.path.join(self.parent, "manifest")
+        self.hooks = os.path.join(self.parent, "hooks")
+        self.measure = False # whether to count the bytes delete and prune free
+        self.reclaimed = 0
         
     def versions(self):
         """ Return StrictVersion objects for every possible version. If
@@ -51,6 +152,23 @@ class Jungle(object):
             except ValueError, e:
                 pass
         
+    def archived(self):
+        """ Return StrictVersion objects for every version held in the archive.
+        These are not returned by versions() and cannot be set until they are
+        restored. """
+        if not os.path.isdir(self.archive):
+            return
+        for item in sorted(os.listdir(self.archive)):
+            if not item.endswith(".tar.gz"):
+                continue
+            try:
+                yield StrictVersion(item[:-7])
+            except ValueError, e:
+                pass
+
+    def archive_path(self, version):
+        return os.path.join(self.archive, str(version) + ".tar.gz")
+
     def oldest(self):
         """ Return the lowest version """
         return sorted(self.versions())[0]
@@ -85,21 +203,186 @@ class Jungle(object):
     def _set(self, version):
         if not self.exists(version):
             raise JungleError("Version %s does not exist" % version)
+        previous = self._pointed(self.current)
+        # setting the version that is already current rewrites the link, but
+        # is not recorded and does not run the hooks
+        switching = previous != str(version)
+        if switching:
+            failed = self._failed(self.run_hooks("pre-switch", previous, version))
+            if failed:
+                raise JungleError("pre-switch hooks failed, not switching to %s: %s" % (version, ", ".join(failed)))
         os.symlink("release/" + str(version), self.current_new)
         os.rename(self.current_new, self.current)
+        if switching:
+            self.record(previous, version)
+            failed = self._failed(self.run_hooks("post-switch", previous, version))
+            if failed:
+                raise JungleError("Switched to %s but post-switch hooks failed: %s" % (version, ", ".join(failed)))
+
+    def _failed(self, results):
+        return [name for name, status, duration in results if status != 0]
+
+    def run_hooks(self, stage, previous, version):
+        """ Run every executable in the hooks/<stage>.d directory of the parent
+        at once, with the versions being switched from and to in the
+        environment as JUNGLE_FROM and JUNGLE_TO. Each hook is killed, along
+        with anything it started, if it is still running after hook_timeout
+        seconds. Returns a list of (name, status, duration) tuples, where
+        status is the exit status or None if the hook could not be run or
+        timed out. """
+        directory = os.path.join(self.hooks, stage + ".d")
+        if not os.path.isdir(directory):
+            return []
+        env = dict(os.environ)
+        env["JUNGLE_PARENT"] = os.path.abspath(self.parent)
+        env["JUNGLE_STAGE"] = stage
+        env["JUNGLE_FROM"] = str(previous or "")
+        env["JUNGLE_TO"] = str(version)
+        results = []
+        running = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.abspath(os.path.join(directory, name))
+            if name.startswith(".") or name.endswith("~"):
+                continue
+            if not os.path.isfile(path) or not os.access(path, os.X_OK):
+                continue
+            started = time.time()
+            try:
+                # each hook gets its own session, so anything it starts can
+                # be killed along with it
+                proc = subprocess.Popen([path], cwd=self.parent, env=env, stdout=sys.stderr,
+                                        preexec_fn=os.setsid)
+            except OSError, e:
+                results.append((name, None, time.time() - started))
+                continue
+            running[name] = (proc, started)
+        while running:
+            for name, (proc, started) in running.items():
+                status = proc.poll()
+                duration = time.time() - started
+                if status is None:
+                    if duration < hook_timeout:
+                        continue
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except OSError, e:
+                        if e.errno != errno.ESRCH:
+                            raise
+                    proc.wait()
+                results.append((name, status, duration))
+                del running[name]
+            if running:
+                time.sleep(0.01)
+        for name, status, duration in results:
+            if status == 0:
+                outcome = "ok"
+            elif status is None:
+                outcome = "failed to complete"
+            else:
+                outcome = "failed with status %d" % status
+            print >>stderr, "%s hook %s %s in %.2fs" % (stage, name, outcome, duration)
+        return results
+
+    def _pointed(self, link):
+        """ Return the version string link points to, or None if it is not a
+        link into release. No other checks are made. """
+        if not os.path.islink(link):
+            return None
+        ln = os.readlink(link)
+        if not ln.startswith("release/"):
+            return None
+        return ln[8:]
+
+    def record(self, previous, version):
+        """ Append an activation of version, replacing previous, to the
+        history. """
+        f = open(self.history, "a")
+        try:
+            f.write("%d %s %s\n" % (time.time(), previous or "-", version))
+        finally:
+            f.close()
+        if os.path.getsize(self.history) > self.history_limit:
+            self.compact_history()
+
+    def compact_history(self):
+        """ Rewrite the history keeping only the most recent entries. """
+        entries = self.history_tail(self.history_keep)
+        new = self.history + ".new"
+        f = open(new, "w")
+        try:
+            for when, previous, version in entries:
+                f.write("%d %s %s\n" % (when, previous or "-", version))
+        finally:
+            f.close()
+        os.rename(new, self.history)
+
+    def history_tail(self, n=None):
+        """ Return the last n entries in the history, or all of them if n is
+        None, oldest first, as (timestamp, previous, version) tuples. Only the
+        end of the file is read. previous is None for the activation done by
+        initialise. """
+        if (n is not None and n < 1) or not os.path.exists(self.history):
+            return []
+        f = open(self.history, "rb")
+        try:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = ""
+            while pos > 0 and (n is None or data.count("\n") <= n):
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        finally:
+            f.close()
+        lines = data.splitlines()
+        if pos > 0:
+            # the first line may be partial
+            lines = lines[1:]
+        entries = []
+        if n is not None:
+            lines = lines[-n:]
+        for line in lines:
+            try:
+                when, previous, version = line.split()
+                when = int(when)
+            except ValueError:
+                raise JungleError("Corrupt history entry %r in %s" % (line, self.history))
+            if previous == "-":
+                previous = None
+            entries.append((when, previous, version))
+        return entries
+
+    def rollback(self, steps=1):
+        """ Set current to the version that was active before the last steps
+        activations, as recorded in the history, and return it. """
+        if steps < 1:
+            raise JungleError("Cannot rollback %d steps" % steps)
+        self.check_current()
+        entries = self.history_tail(steps)
+        if len(entries) < steps or entries[0][1] is None:
+            raise JungleError("Not enough history to rollback %d steps" % steps)
+        return self.set(entries[0][1])
         
-    def set(self, version):
+    def set(self, version, verify=False):
+        """ Set current to version. If verify is True the version is first
+        checked against its manifest, and current is left alone if it does
+        not match. """
         self.check_current()
         if not isinstance(version, StrictVersion):
             version = StrictVersion(version)
         if not os.path.exists(self.current):
             raise JungleError("No current exists for %s - is this an initialised jungle?" % self.parent)
+        if verify:
+            problems = self.verify(version)
+            if problems:
+                raise JungleError("Version %s failed verification, not setting: %s" % (version, "; ".join(problems)))
         self._set(version)
         return version
 
-    def delete(self, version):
-        """ Delete the specified version. Raises an error if the specified
-        version is current. """
+    def _removable(self, version):
+        """ Check that version may be removed from release, and return it as a
+        StrictVersion. """
         self.check_current()
         if not isinstance(version, StrictVersion):
             version = StrictVersion(version)
@@ -109,48 +392,315 @@ class Jungle(object):
             raise JungleError("No current exists for %s - is this an initialised jungle?" % self.parent)
         if version == self.current_version():
             raise JungleError("Will not delete current version")
+        pointers = self._pointers()
+        if str(version) in pointers:
+            raise JungleError("Will not delete the version pointed to by %s" % pointers[str(version)])
+        return version
+
+    def delete(self, version):
+        """ Delete the specified version. Raises an error if the specified
+        version is current. """
+        version = self._removable(version)
         if verbose:
             print >>sys.stderr, "Deleting version %s" % (version,)
+        if self.measure:
+            self.reclaimed += disk_usage(self.path(version))
         shutil.rmtree(self.path(version))
+        try:
+            os.remove(self.manifest_path(version))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def manifest_path(self, version):
+        return os.path.join(self.manifests, str(version))
+
+    def _scan(self, version, workers=None):
+        """ Return manifest entries for every file in version, hashing them
+        across a pool of worker processes. """
+        root = self.path(version)
+        jobs = [(root, p) for p in walk_release(root)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            entries = pool.map(file_entry, jobs, chunksize=256)
+        finally:
+            pool.close()
+            pool.join()
+        return entries
+
+    def record_manifest(self, version, workers=None):
+        """ Record the size, mode, mtime and hash of every file in version, so
+        it can later be checked with verify. """
+        if not isinstance(version, StrictVersion):
+            version = StrictVersion(version)
+        if not self.exists(version):
+            raise JungleError("Version %s does not exist" % version)
+        entries = self._scan(version, workers)
+        if not os.path.isdir(self.manifests):
+            os.mkdir(self.manifests)
+        target = self.manifest_path(version)
+        new = target + ".new"
+        f = open(new, "w")
+        try:
+            for relpath, size, mode, mtime, digest in entries:
+                f.write("%s\t%o\t%d\t%d\t%s\n" % (digest, mode, size, mtime, relpath))
+        finally:
+            f.close()
+        os.rename(new, target)
+
+    def manifest(self, version):
+        """ Return the recorded manifest for version as a dictionary mapping
+        relative path to (size, mode, mtime, digest). """
+        path = self.manifest_path(version)
+        if not os.path.exists(path):
+            raise JungleError("No manifest recorded for version %s" % version)
+        manifest = {}
+        for line in open(path):
+            digest, mode, size, mtime, relpath = line.rstrip("\n").split("\t", 4)
+            manifest[relpath] = (int(size), int(mode, 8), int(mtime), digest)
+        return manifest
+
+    def verify(self, version, quick=False, workers=None):
+        """ Check version against its manifest and return a list of problems,
+        which is empty if it matches. Normally every file is hashed, across a
+        pool of worker processes. If quick is True only the size and mtime of
+        each file are compared. """
+        if not isinstance(version, StrictVersion):
+            version = StrictVersion(version)
+        if not self.exists(version):
+            raise JungleError("Version %s does not exist" % version)
+        expected = self.manifest(version)
+        root = self.path(version)
+        problems = []
+        if quick:
+            found = set(walk_release(root))
+            for relpath in sorted(found & set(expected)):
+                size, mode, mtime, digest = expected[relpath]
+                st = os.lstat(os.path.join(root, relpath))
+                if stat.S_ISDIR(st.st_mode) != stat.S_ISDIR(mode):
+                    problems.append("%s has changed type" % relpath)
+                elif not stat.S_ISDIR(mode) and st.st_size != size:
+                    problems.append("%s has changed size" % relpath)
+                elif not stat.S_ISDIR(mode) and int(st.st_mtime) != mtime:
+                    problems.append("%s has changed mtime" % relpath)
+        else:
+            entries = self._scan(version, workers)
+            found = set()
+            for relpath, size, mode, mtime, digest in entries:
+                found.add(relpath)
+                if relpath not in expected:
+                    continue
+                e_size, e_mode, e_mtime, e_digest = expected[relpath]
+                if mode != e_mode:
+                    problems.append("%s has changed mode" % relpath)
+                elif digest != e_digest or (digest != "-" and size != e_size):
+                    problems.append("%s has changed content" % relpath)
+        for relpath in sorted(set(expected) - found):
+            problems.append("%s is missing" % relpath)
+        for relpath in sorted(found - set(expected)):
+            problems.append("%s is not in the manifest" % relpath)
+        return problems
+
+    def archive_versions(self, versions, workers=None):
+        """ Move the specified versions out of release and into compressed
+        tarballs in the archive directory. Compression is done by a pool of
+        worker processes, one per CPU unless workers is given. Will not
+        archive the current version. """
+        versions = [self._removable(v) for v in versions]
+        if not versions:
+            return
+        if not os.path.isdir(self.archive):
+            os.mkdir(self.archive)
+        jobs = []
+        for v in versions:
+            if verbose:
+                print >>sys.stderr, "Archiving version %s" % (v,)
+            jobs.append((self.path(v), self.archive_path(v), self.measure))
+        failed = []
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = [pool.apply_async(archive_release, job) for job in jobs]
+            for v, r in zip(versions, results):
+                try:
+                    self.reclaimed += r.get()
+                except (OSError, IOError, tarfile.TarError), e:
+                    failed.append("%s (%s)" % (v, e))
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            raise JungleError("Failed to archive %s" % ", ".join(failed))
+
+    def restore(self, version):
+        """ Extract an archived version back into release, so it can be set
+        again. The release is extracted alongside and renamed into place, and
+        the archive removed once it has been restored. """
+        if not isinstance(version, StrictVersion):
+            version = StrictVersion(version)
+        if self.exists(version):
+            raise JungleError("Version %s already exists" % version)
+        source = self.archive_path(version)
+        if not os.path.exists(source):
+            raise JungleError("Version %s is not archived" % version)
+        staging = os.path.join(self.release, ".restore-%s" % version)
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.mkdir(staging)
+        if verbose:
+            print >>sys.stderr, "Restoring version %s" % (version,)
+        try:
+            try:
+                tar = tarfile.open(source, "r|gz")
+                try:
+                    tar.extractall(staging, members=self._members(tar, version))
+                finally:
+                    tar.close()
+            except (tarfile.TarError, IOError), e:
+                raise JungleError("Cannot restore version %s: %s" % (version, e))
+            if not os.path.isdir(os.path.join(staging, str(version))):
+                raise JungleError("Archive for %s does not contain the directory %s" % (version, version))
+        except:
+            shutil.rmtree(staging)
+            raise
+        os.rename(os.path.join(staging, str(version)), self.path(version))
+        os.rmdir(staging)
+        os.remove(source)
+        return version
+
+    def _members(self, tar, version):
+        """ Yield the members of tar, refusing anything that would land
+        outside the directory for version. That is a member named outside
+        it, a hard link to something outside it, a member that repeats an
+        earlier one, or a member or hard link at or below a symlink extracted
+        earlier, which would be written or linked through it. """
+        prefix = str(version)
+        def inside(name):
+            return name == prefix or name.startswith(prefix + os.sep)
+        def through(name):
+            while name:
+                if name in symlinks:
+                    return True
+                name = os.path.dirname(name)
+            return False
+        seen = set()
+        symlinks = set()
+        for info in tar:
+            name = os.path.normpath(info.name)
+            if not inside(name):
+                raise JungleError("Archive for %s contains unexpected member %r" % (version, info.name))
+            if name in seen:
+                raise JungleError("Archive for %s contains member %r more than once" % (version, info.name))
+            if through(name):
+                raise JungleError("Archive for %s contains member %r below a symlink" % (version, info.name))
+            if info.islnk():
+                linkname = os.path.normpath(info.linkname)
+                if not inside(linkname) or through(linkname):
+                    raise JungleError("Archive for %s contains unexpected link %r" % (version, info.name))
+            seen.add(name)
+            if info.issym():
+                symlinks.add(name)
+            yield info
+
+    def _discard(self, versions, archive=False):
+        if archive:
+            self.archive_versions(versions)
+        else:
+            for v in versions:
+                self.delete(v)
 
     def upgrade(self):
         """ Set current to head """
         self.check_current()
         return self.set(self.head())
     
-    def degrade(self, dry_run=False):
+    def degrade(self, dry_run=False, verify=False):
         """ Set current to head - 1 and returns the version chosen. If dry-run
-        is True then just returns the version chosen. """
+        is True then just returns the version chosen. verify is as for set. """
         self.check_current()
         v = list(self.versions())
         if len(v) < 2:
             raise JungleError("Not enough versions to rollback")
         previous = sorted(v)[-2]
         if not dry_run:
-            self.set(previous)
+            self.set(previous, verify=verify)
         return str(previous)
     
     def check_current(self):
         """ Perform complete sanity checks on the status of current. Try to
         rule out any of the mental states a jungle could get into if someone
         tries to do stuff by hand. """
-        current = self.current
-        if not os.path.exists(current):
+        if not os.path.exists(self.current):
             raise JungleError("No current exists for %s - is this an initialised jungle?" % self.parent)
-        if not os.path.islink(current):
-            raise JungleError("Current %s is not a symlink, bailing" % current)
-        ln = os.readlink(current)
+        return self._check_link(self.current, "Current")
+
+    current_version = check_current
+
+    def check_next(self):
+        """ Perform the same checks as check_current on next, and return the
+        version it points to. """
+        if not os.path.exists(self.next):
+            raise JungleError("No next exists for %s - use stage-next first" % self.parent)
+        return self._check_link(self.next, "Next")
+
+    def _check_link(self, link, name):
+        if not os.path.islink(link):
+            raise JungleError("%s %s is not a symlink, bailing" % (name, link))
+        ln = os.readlink(link)
         if not ln.startswith("release/"):
-            raise JungleError("Current %s does not point to something in release!" % current)
+            raise JungleError("%s %s does not point to something in release!" % (name, link))
         try:
             version = StrictVersion(ln[8:])
         except ValueError:
-            raise JungleError("Current %s does not point to a valid version!" % current)
+            raise JungleError("%s %s does not point to a valid version!" % (name, link))
         if not os.path.isdir(self.path(version)):
-            raise JungleError("Current does not point to a valid directory!" % current)
+            raise JungleError("%s %s does not point to a valid directory!" % (name, link))
         return version
 
-    current_version = check_current
+    def _link(self, link, new, version):
+        os.symlink("release/" + str(version), new)
+        os.rename(new, link)
+
+    def stage_next(self, version):
+        """ Point next at version, so a standby can be started from it ahead
+        of promote. """
+        current = self.check_current()
+        if not isinstance(version, StrictVersion):
+            version = StrictVersion(version)
+        if not self.exists(version):
+            raise JungleError("Version %s does not exist" % version)
+        if version == current:
+            raise JungleError("Version %s is already current" % version)
+        self._link(self.next, self.next_new, version)
+        self.check_next()
+        return version
+
+    def _pointers(self):
+        """ Return a dictionary mapping the versions pointed to by next and
+        previous to the name of the pointer. These versions are protected
+        from delete and prune. """
+        pointers = {}
+        for link, name in ((self.previous, "previous"), (self.next, "next")):
+            version = self._pointed(link)
+            if version is not None:
+                pointers[version] = name
+        return pointers
+
+    def promote(self):
+        """ Swap current and next, so the staged version becomes current in a
+        single rename, and return it. The version that was current is kept as
+        previous, and becomes next. """
+        old = self.check_current()
+        new = self.check_next()
+        if new == old:
+            raise JungleError("Next %s is already current" % new)
+        try:
+            self._set(new)
+        finally:
+            # post-switch hooks can fail after current has moved
+            if self._pointed(self.current) == str(new):
+                self._link(self.previous, self.previous_new, old)
+                self._link(self.next, self.next_new, old)
+        return new
     
     def status(self):
         """ Prints "current" or "degraded" depending on state """
@@ -158,6 +708,11 @@ class Jungle(object):
         if current == self.head():
             return "current"
         return "degraded"
+
+    def gap(self):
+        """ Return the number of versions newer than current """
+        current = self.check_current()
+        return len([v for v in self.versions() if v > current])
     
     def age(self, version):
         ftime = os.stat(self.path(version))[stat.ST_MTIME]
@@ -166,30 +721,48 @@ class Jungle(object):
         days = int(age/(60*60*24.0))
         return days
         
-    def prune_age(self, age):
+    def prune_age(self, age, archive=False):
         """ Delete versions older than age days. Will not delete the current
-        version. """
+        version, or the versions pointed to by next and previous. If archive
+        is True the versions are archived instead. """
         self.check_current()
+        pointers = self._pointers()
+        victims = []
         for v in self.versions():
             if v == self.current_version():
                 if verbose:
                     print "Skipping current"
+            elif str(v) in pointers:
+                if verbose:
+                    print "Skipping %s" % pointers[str(v)]
             else:
                 days = self.age(v)
                 if days > age:
-                    self.delete(v)
+                    victims.append(v)
+        self._discard(victims, archive)
     
-    def prune_iterations(self, n):
+    def prune_iterations(self, n, archive=False):
         """ Maintain a maximum of n versions. Will remove old versions until
-        there are n remaining """
-        self.check_current()
-        while len(list(self.versions())) > n:
-            if self.oldest() == self.current_version():
-                raise JungleError("I won't delete the current version, bailing.")
-            self.delete(self.oldest())
+        there are n remaining. The versions pointed to by next and previous
+        are neither removed nor counted. If archive is True the versions are
+        archived instead. """
+        current = self.check_current()
+        pointers = self._pointers()
+        v = sorted(x for x in self.versions() if x == current or str(x) not in pointers)
+        victims = v[:max(len(v) - n, 0)]
+        if current in victims:
+            raise JungleError("I won't delete the current version, bailing.")
+        self._discard(victims, archive)
         
     
 class Cmd:
+
+    jungle = None # the last jungle opened, for metrics
+
+    def _jungle(self, parent):
+        self.jungle = Jungle(parent)
+        self.jungle.measure = metrics_file is not None
+        return self.jungle
     
     def _parent(self, args, argc=1):
         if argc == 1:
@@ -227,7 +800,7 @@ class Cmd:
     def do_init(self, opts, args):
         parent, _ = self._parent(args)
         print "Initialising jungle in", parent
-        j = Jungle(parent)
+        j = self._jungle(parent)
         j.initialise()
         
     def help_set(self):
@@ -236,13 +809,19 @@ class Cmd:
         print
         print "Usage:"
         print
-        print "    jungle set [pathname] <version>"
+        print "    jungle set [--verify] [pathname] <version>"
+        print
+        print "With --verify the version is checked against its manifest first, and"
+        print "current is left alone if it does not match."
+
+    def opts_set(self, p):
+        p.add_option("--verify", default=False, action="store_true", help="verify against the manifest first")
         
     def do_set(self, opts, args):
         parent, r = self._parent(args, argc=2)
-        j = Jungle(parent)
+        j = self._jungle(parent)
         version = r[0]
-        j.set(version)
+        j.set(version, verify=opts.verify)
         
     def help_upgrade(self):
         print
@@ -254,7 +833,7 @@ class Cmd:
 
     def do_upgrade(self, opts, args):
         parent, _ = self._parent(args)
-        j = Jungle(parent)
+        j = self._jungle(parent)
         j.upgrade()
         
     def help_degrade(self):
@@ -263,15 +842,16 @@ class Cmd:
         print
         print "Usage:"
         print
-        print "    jungle degrade [--dry-run] [pathname]"
+        print "    jungle degrade [--dry-run] [--verify] [pathname]"
 
     def opts_degrade(self, p):
         p.add_option("--dry-run", default=False, action="store_true", help="don't make any changes")
+        p.add_option("--verify", default=False, action="store_true", help="verify against the manifest first")
         
     def do_degrade(self, opts, args):
         parent, _ = self._parent(args)
-        j = Jungle(parent)
-        j.degrade(dry_run=opts.dry_run)
+        j = self._jungle(parent)
+        j.degrade(dry_run=opts.dry_run, verify=opts.verify)
         
     def help_current(self):
         print
@@ -283,7 +863,7 @@ class Cmd:
     
     def do_current(self, opts, args):
         parent, _ = self._parent(args)
-        j = Jungle(parent)
+        j = self._jungle(parent)
         print j.current_version()
         
     def help_status(self):
@@ -296,7 +876,7 @@ class Cmd:
     
     def do_status(self, opts, args):
         parent, _ = self._parent(args)
-        j = Jungle(parent)
+        j = self._jungle(parent)
         print j.status()
         
     def help_prune(self):
@@ -307,21 +887,53 @@ class Cmd:
         print
         print "Usage:"
         print
-        print "    jungle prune [--age N] [--iterations N] [pathname]"
+        print "    jungle prune [--age N] [--iterations N] [--archive] [pathname]"
+        print
+        print "With --archive old versions are compressed into the archive directory"
+        print "instead of being deleted, and can be brought back with restore."
         
     def opts_prune(self, p):
         p.add_option("--age", default=None, action="store", type="int", help="age in days to preserve")
         p.add_option("--iterations", default=None, action="store", type="int", help="iterations to preserve")
+        p.add_option("--archive", default=False, action="store_true", help="archive rather than delete")
     
     def do_prune(self, opts, args):
         if (opts.age is None) == (opts.iterations is None):
             raise JungleError("One and only one of age or iterations must be chosen")
         parent, _ = self._parent(args)
-        j = Jungle(parent)
+        j = self._jungle(parent)
         if opts.age is not None:
-            j.prune_age(opts.age)
+            j.prune_age(opts.age, archive=opts.archive)
         if opts.iterations is not None:
-            j.prune_iterations(opts.iterations)
+            j.prune_iterations(opts.iterations, archive=opts.archive)
+
+    def help_restore(self):
+        print
+        print "Restore an archived version into the release directory, so it can be set."
+        print
+        print "Usage:"
+        print
+        print "    jungle restore [pathname] <version>"
+
+    def do_restore(self, opts, args):
+        parent, r = self._parent(args, argc=2)
+        j = self._jungle(parent)
+        version = r[0]
+        j.restore(version)
+
+    def help_archived(self):
+        print
+        print "Print the versions held in the archive"
+        print
+        print "Usage:"
+        print
+        print "    jungle archived [pathname]"
+
+    def do_archived(self, opts, args):
+        parent, _ = self._parent(args)
+        j = self._jungle(parent)
+        for v in j.archived():
+            print v
             
     def help_delete(self):
         print
@@ -333,15 +945,113 @@ class Cmd:
     
     def do_delete(self, opts, args):
         parent, r = self._parent(args, argc=2)
-        j = Jungle(parent)
+        j = self._jungle(parent)
         version = r[0]
         j.delete(version)
     
+    def help_manifest(self):
+        print
+        print "Record the size, mode and hash of every file in the specified version, so"
+        print "it can later be checked with verify. Run this when a version is installed."
+        print
+        print "Usage:"
+        print
+        print "    jungle manifest [pathname] <version>"
+
+    def do_manifest(self, opts, args):
+        parent, r = self._parent(args, argc=2)
+        j = self._jungle(parent)
+        version = r[0]
+        j.record_manifest(version)
+
+    def help_verify(self):
+        print
+        print "Check the specified version against its manifest, printing any differences."
+        print "With --quick only the size and mtime of each file are compared."
+        print
+        print "Usage:"
+        print
+        print "    jungle verify [--quick] [pathname] <version>"
+
+    def opts_verify(self, p):
+        p.add_option("--quick", default=False, action="store_true", help="compare size and mtime only")
+
+    def do_verify(self, opts, args):
+        parent, r = self._parent(args, argc=2)
+        j = self._jungle(parent)
+        version = r[0]
+        problems = j.verify(version, quick=opts.quick)
+        for p in problems:
+            print p
+        if problems:
+            raise JungleError("Version %s failed verification" % version)
+
+    def help_stage_next(self):
+        print
+        print "Point next at the specified version, so a standby can be started from it"
+        print "before it is promoted."
+        print
+        print "Usage:"
+        print
+        print "    jungle stage-next [pathname] <version>"
+
+    def do_stage_next(self, opts, args):
+        parent, r = self._parent(args, argc=2)
+        j = self._jungle(parent)
+        version = r[0]
+        j.stage_next(version)
+
+    def help_promote(self):
+        print
+        print "Swap current and next, so the staged version becomes current, and print it."
+        print "The version that was current is kept as previous."
+        print
+        print "Usage:"
+        print
+        print "    jungle promote [pathname]"
+
+    def do_promote(self, opts, args):
+        parent, _ = self._parent(args)
+        j = self._jungle(parent)
+        print j.promote()
+
+    def help_rollback(self):
+        print
+        print "Set the current to the version that was active before the last activation,"
+        print "as recorded in the history, and print the version chosen. With --steps N go"
+        print "back N activations."
+        print
+        print "Usage:"
+        print
+        print "    jungle rollback [--steps N] [pathname]"
+
+    def opts_rollback(self, p):
+        p.add_option("--steps", default=1, action="store", type="int", help="activations to go back")
+
+    def do_rollback(self, opts, args):
+        parent, _ = self._parent(args)
+        j = self._jungle(parent)
+        print j.rollback(steps=opts.steps)
+
+    def help_history(self):
+        print
+        print "Print the history of activations, oldest first"
+        print
+        print "Usage:"
+        print
+        print "    jungle history [pathname]"
+
+    def do_history(self, opts, args):
+        parent, _ = self._parent(args)
+        j = self._jungle(parent)
+        for when, previous, version in j.history_tail():
+            print time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), previous or "-", version
+
     def do_help(self, opts, args):
         if len(args) == 0:
             print "Help!"
         elif len(args) == 1:
-            helpfunc = getattr(self, "help_" + args[0], None)
+            helpfunc = getattr(self, "help_" + args[0].replace("-", "_"), None)
             if helpfunc is not None:
                 helpfunc()
             else:
@@ -353,19 +1063,29 @@ def parse_command(args):
     """ Avoiding dependencies on things like argparse, to make this as simple
     and portable as possible. sigh. """
 
-    global verbose
+    global verbose, hook_timeout, metrics_file
     if len(args) == 0:
         return cmd.do_help, {}, []
     while args and args[0].startswith("-"):
         if args[0] == '-v':
             verbose = True
             args = args[1:]
+        elif args[0] == '-t' and len(args) > 1:
+            try:
+                hook_timeout = float(args[1])
+            except ValueError:
+                print >>stderr, "Invalid hook timeout: %s" % args[1]
+                raise SystemExit(-1)
+            args = args[2:]
+        elif args[0] == '--metrics-file' and len(args) > 1:
+            metrics_file = args[1]
+            args = args[2:]
         else:
             print >>stderr, "Unrecognised argument: %s" % args[0]
             raise SystemExit(-1)
     if len(args) == 0:
         return cmd.do_help, {}, []
-    command = args[0]
+    command = args[0].replace("-", "_")
     func = getattr(cmd, "do_" + command, None)
     if func is None:
         print >>stderr, "Unrecognised command: %s" % args[0]
@@ -377,12 +1097,87 @@ def parse_command(args):
     opts, args = p.parse_args(args[1:])
     return func, opts, args
 
+def write_metrics(path, command, j, duration, success):
+    """ Write metrics about a command, and the state of the jungle j it was run
+    on, to the node_exporter textfile path. The file is written alongside and
+    renamed into place, so the collector never sees a partial file. Samples
+    for other commands already in the file are kept. """
+    labels = {}
+    if j is not None:
+        labels["parent"] = os.path.abspath(j.parent)
+    metrics = [
+        ("jungle_operation_duration_seconds", "Time taken by the last run of a jungle command.",
+         dict(labels, command=command), duration),
+        ("jungle_operation_success", "Whether the last run of a jungle command succeeded.",
+         dict(labels, command=command), int(success)),
+        ]
+    if j is not None:
+        metrics.append(("jungle_reclaimed_bytes", "Bytes freed by the last run of a jungle command.",
+                        dict(labels, command=command), j.reclaimed))
+        try:
+            metrics.append(("jungle_versions", "Number of versions in release.",
+                            labels, len(list(j.versions()))))
+            metrics.append(("jungle_archived_versions", "Number of versions in the archive.",
+                            labels, len(list(j.archived()))))
+            metrics.append(("jungle_head_gap", "Number of versions newer than current.",
+                            labels, j.gap()))
+            last = j.history_tail(1)
+            if last:
+                metrics.append(("jungle_last_switch_timestamp_seconds", "Time current was last changed.",
+                                labels, last[0][0]))
+        except (JungleError, OSError):
+            pass
+    # samples already in the file, from other commands or other jungles,
+    # are carried forward unless replaced by one with the same labels
+    descriptions = {}
+    samples = {}
+    order = []
+    for name, description, labels, value in metrics:
+        labels = ",".join('%s="%s"' % (k, labels[k].replace("\\", "\\\\").replace('"', '\\"'))
+                          for k in sorted(labels))
+        if name not in descriptions:
+            descriptions[name] = description
+            samples[name] = []
+            order.append(name)
+        samples[name].append(("%s{%s}" % (name, labels), value))
+    if os.path.exists(path):
+        for line in open(path):
+            line = line.rstrip("\n")
+            if line.startswith("# HELP "):
+                name, description = line[7:].split(" ", 1)
+                if name not in descriptions:
+                    descriptions[name] = description
+                    samples[name] = []
+                    order.append(name)
+            elif line and not line.startswith("#"):
+                key, value = line.rsplit(" ", 1)
+                name = key.split("{")[0]
+                if name in samples and key not in [k for k, v in samples[name]]:
+                    samples[name].append((key, value))
+    new = path + ".new"
+    f = open(new, "w")
+    try:
+        for name in order:
+            print >>f, "# HELP %s %s" % (name, descriptions[name])
+            print >>f, "# TYPE %s gauge" % name
+            for key, value in samples[name]:
+                print >>f, "%s %s" % (key, value)
+    finally:
+        f.close()
+    os.rename(new, path)
+
 if __name__ == '__main__':
     import wingdbstub
 
     func, opts, args = parse_command(sys.argv[1:])
+    started = time.time()
+    success = False
     try:
         func(opts, args)
+        success = True
     except JungleError, e:
         print str(e)
-        raise SystemExit(-1)
\ No newline at end of file
+        raise SystemExit(-1)
+    finally:
+        if metrics_file is not None:
+            write_metrics(metrics_file, func.__name__[3:], cmd.jungle, time.time() - started, success)
\ No newline at end of file
@@ -58,6 +58,20 @@ class CommandParseTest(TestCase):
         parse_command(['-v'])
         self.assertEqual(jungle.verbose, True)
         jungle.verbose = False
+
+    def test_hyphenated(self):
+        self.assertEqual(parse_command(['stage-next', '2.0']), (cmd.do_stage_next, {}, ['2.0']))
+
+    def test_hook_timeout(self):
+        self.assertEqual(parse_command(['-t', '5', 'init']), (cmd.do_init, {}, []))
+        self.assertEqual(jungle.hook_timeout, 5)
+        jungle.hook_timeout = 60
+        self.assertRaises(SystemExit, parse_command, ['-t', 'x', 'init'])
+
+    def test_metrics_file(self):
+        self.assertEqual(parse_command(['--metrics-file', '/m.prom', 'init']), (cmd.do_init, {}, []))
+        self.assertEqual(jungle.metrics_file, '/m.prom')
+        jungle.metrics_file = None
         
     def test_init(self):
         self.assertEqual(parse_command(['init']), (cmd.do_init, {}, []))
@@ -129,7 +143,7 @@ class JungleTest(TestCase):
         return exists
             
     def test_initialise(self):
-        with multipatch('os.symlink', 'os.rename') as m:
+        with multipatch('os.symlink', 'os.rename', 'jungle.Jungle.record', 'jungle.Jungle.run_hooks') as m:
             m['os.listdir'].return_value = ['1.0']
             m['os.path.exists'].side_effect = self._exists("/t/current")
             m['os.path.isdir'].return_value = True
@@ -160,7 +174,7 @@ class JungleTest(TestCase):
             j.check_current()
         
     def test_set(self):        
-        with multipatch('os.symlink', 'os.rename') as m:
+        with multipatch('os.symlink', 'os.rename', 'jungle.Jungle.record', 'jungle.Jungle.run_hooks') as m:
             self._pass_current_checks(m)
             m['os.listdir'].return_value = ['1.0']
             m['os.path.exists'].side_effect = self._exists("/t/current")
@@ -189,7 +203,7 @@ class JungleTest(TestCase):
             self.assertRaises(JungleError, j.delete, "1.0")
 
     def test_degrade(self):
-        with multipatch('os.symlink', 'os.rename') as m:
+        with multipatch('os.symlink', 'os.rename', 'jungle.Jungle.record', 'jungle.Jungle.run_hooks') as m:
             m['os.listdir'].return_value = ['1.0', '2.0', '1.0b3']
             self._pass_current_checks(m)
             j = Jungle("/t")
@@ -198,7 +212,7 @@ class JungleTest(TestCase):
             m['os.symlink'].assert_called_with('release/1.0', '/t/current.new')
             
     def test_upgrade(self):
-        with multipatch('os.symlink', 'os.rename') as m:
+        with multipatch('os.symlink', 'os.rename', 'jungle.Jungle.record', 'jungle.Jungle.run_hooks') as m:
             m['os.listdir'].return_value = ['1.0', '2.0', '1.0b3']
             self._pass_current_checks(m)
             j = Jungle("/t")
@@ -294,6 +308,57 @@ class JungleTest(TestCase):
             m['shutil.rmtree'].assert_any_call_with('/t/release/1.0b3')
             m['shutil.rmtree'].assert_any_call_with('/t/release/1.0')
             
+    def test_set_records_history(self):
+        with multipatch('os.symlink', 'os.rename', 'jungle.Jungle.record', 'jungle.Jungle.run_hooks') as m:
+            self._pass_current_checks(m)
+            m['os.listdir'].return_value = ['1.0', '2.0']
+            j = Jungle("/t")
+            j.set('2.0')
+            m['jungle.Jungle.record'].assert_called_with('1.0', StrictVersion('2.0'))
+
+    def test_set_verify(self):
+        with multipatch('os.symlink', 'os.rename', 'jungle.Jungle.record', 'jungle.Jungle.run_hooks', 'jungle.Jungle.verify') as m:
+            self._pass_current_checks(m)
+            m['os.listdir'].return_value = ['1.0', '2.0']
+            m['jungle.Jungle.verify'].return_value = ['foo is missing']
+            j = Jungle("/t")
+            self.assertRaises(JungleError, j.set, '2.0', verify=True)
+            self.assertEqual(m['os.symlink'].call_count, 0)
+            m['jungle.Jungle.verify'].return_value = []
+            j.set('2.0', verify=True)
+            m['os.symlink'].assert_called_with('release/2.0', '/t/current.new')
+
+    def test_stage_next(self):
+        with multipatch('os.symlink', 'os.rename') as m:
+            self._pass_current_checks(m)
+            j = Jungle("/t")
+            self.assertRaises(JungleError, j.stage_next, '1.0')
+            m['os.readlink'].side_effect = lambda x: {'/t/current': 'release/1.0',
+                                                      '/t/next': 'release/2.0',
+                                                      '/t/previous': 'release/1.0'}[x]
+            j.stage_next('2.0')
+            m['os.symlink'].assert_called_with('release/2.0', '/t/next.new')
+            m['os.rename'].assert_called_with("/t/next.new", "/t/next")
+
+    def test_delete_next(self):
+        with multipatch('shutil.rmtree') as m:
+            self._pass_current_checks(m)
+            m['os.readlink'].side_effect = lambda x: {'/t/current': 'release/1.0',
+                                                      '/t/next': 'release/2.0',
+                                                      '/t/previous': 'release/1.0'}[x]
+            j = Jungle("/t")
+            self.assertRaises(JungleError, j.delete, "2.0")
+            self.assertEqual(m['shutil.rmtree'].call_count, 0)
+
+    def test_archived(self):
+        with multipatch() as m:
+            m['os.path.exists'].return_value = True
+            m['os.path.isdir'].return_value = True
+            m['os.listdir'].return_value = ['2.0.tar.gz', '1.0.tar.gz', 'bin.tar.gz', '3.0.tar.gz.new']
+            j = Jungle("/t")
+            self.assertEqual(list(j.archived()),
+                             [StrictVersion('1.0'), StrictVersion('2.0')])
+
     def test_prune_iterations_keep_current(self):
         versions = ['1.0', '2.0', '1.0b3', '1.1', '1.5']
         def fake_rmtree(pathname):
@@ -404,6 +469,336 @@ class JungleSystemTest(TestCase):
         self.assert_(os.path.exists("j/release/3.0"))
         self.assert_(os.path.exists("j/release/4.0"))
 
+    def test_prune_archive(self):
+        os.mkdir("j/release/2.0")
+        os.mkdir("j/release/3.0")
+        open("j/release/1.0/foo", "w").write("foo")
+        self.jungle("upgrade")
+        self.jungle2("prune", opts=["--iterations", "1", "--archive"])
+        self.assert_(not os.path.exists("j/release/1.0"))
+        self.assert_(not os.path.exists("j/release/2.0"))
+        self.assert_(os.path.exists("j/archive/1.0.tar.gz"))
+        self.assert_(os.path.exists("j/archive/2.0.tar.gz"))
+        self.assertEqual(self.jungle("archived"), "1.0\n2.0\n")
+
+    def test_restore(self):
+        os.mkdir("j/release/2.0")
+        open("j/release/1.0/foo", "w").write("foo")
+        self.jungle("upgrade")
+        self.jungle2("prune", opts=["--iterations", "1", "--archive"])
+        self.jungle("restore", "1.0")
+        self.assertEqual(open("j/release/1.0/foo").read(), "foo")
+        self.assert_(not os.path.exists("j/archive/1.0.tar.gz"))
+        self.jungle("set", "1.0")
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+
+    def test_history(self):
+        os.mkdir("j/release/2.0")
+        self.jungle("set", "2.0")
+        lines = self.jungle("history").splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assert_(lines[0].endswith(" - 1.0"))
+        self.assert_(lines[1].endswith(" 1.0 2.0"))
+
+    def test_rollback(self):
+        os.mkdir("j/release/2.0")
+        os.mkdir("j/release/3.0")
+        self.jungle("upgrade")
+        self.jungle("set", "2.0")
+        # rollback returns to the previously active version, not head-1
+        self.assertEqual(self.jungle("rollback"), "3.0\n")
+        self.assertEqual(os.readlink("j/current"), "release/3.0")
+        self.assertEqual(self.jungle2("rollback", opts=["--steps", "3"]), "1.0\n")
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+
+    def test_restore_through_symlink(self):
+        import tarfile, StringIO
+        os.mkdir("j/archive")
+        tar = tarfile.open("j/archive/2.0.tar.gz", "w:gz")
+        link = tarfile.TarInfo("2.0/lib")
+        link.type = tarfile.SYMTYPE
+        link.linkname = os.path.abspath("j")
+        tar.addfile(link)
+        evil = tarfile.TarInfo("2.0/lib/evil")
+        evil.size = 4
+        tar.addfile(evil, StringIO.StringIO("evil"))
+        tar.close()
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "restore", "2.0")
+        self.assert_(not os.path.exists("j/evil"))
+        self.assert_(not os.path.exists("j/release/2.0"))
+
+    def evil_archive(self, *members):
+        import tarfile, StringIO
+        os.mkdir("j/archive")
+        tar = tarfile.open("j/archive/2.0.tar.gz", "w:gz")
+        for name, type, linkname in members:
+            info = tarfile.TarInfo(name)
+            info.type = type
+            info.linkname = linkname
+            if type == tarfile.REGTYPE:
+                info.size = 4
+                tar.addfile(info, StringIO.StringIO("evil"))
+            else:
+                tar.addfile(info)
+        tar.close()
+
+    def test_restore_over_symlink(self):
+        import tarfile
+        open("j/outside", "w").write("good")
+        self.evil_archive(("2.0", tarfile.DIRTYPE, ""),
+                          ("2.0/foo", tarfile.SYMTYPE, os.path.abspath("j/outside")),
+                          ("2.0/foo", tarfile.REGTYPE, ""))
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "restore", "2.0")
+        self.assertEqual(open("j/outside").read(), "good")
+        self.assert_(not os.path.exists("j/release/2.0"))
+
+    def test_restore_hard_link_through_symlink(self):
+        import tarfile
+        open("j/outside", "w").write("good")
+        self.evil_archive(("2.0", tarfile.DIRTYPE, ""),
+                          ("2.0/lib", tarfile.SYMTYPE, os.path.abspath("j")),
+                          ("2.0/bar", tarfile.LNKTYPE, "2.0/lib/outside"))
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "restore", "2.0")
+        self.assert_(not os.path.exists("j/release/2.0"))
+
+    def test_restore_empty_archive(self):
+        self.evil_archive()
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "restore", "2.0")
+        self.assertEqual(os.listdir("j/release"), ["1.0"])
+
+    def test_rollback_after_upgrade_at_head(self):
+        os.mkdir("j/release/2.0")
+        self.jungle("upgrade")
+        self.jungle("upgrade")
+        self.jungle("upgrade")
+        self.assertEqual(len(self.jungle("history").splitlines()), 2)
+        self.assertEqual(self.jungle("rollback"), "1.0\n")
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+
+    def test_rollback_steps(self):
+        j = Jungle("j")
+        self.assertRaises(JungleError, j.rollback, 0)
+        self.assertRaises(JungleError, j.rollback, -1)
+
+    def test_rollback_no_history(self):
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "rollback")
+
+    def test_history_compact(self):
+        os.mkdir("j/release/2.0")
+        j = Jungle("j")
+        j.history_limit = 200
+        j.history_keep = 3
+        for i in range(10):
+            j.set("2.0")
+            j.set("1.0")
+        self.assert_(os.path.getsize("j/history") <= 200)
+        self.assertEqual([e[1:] for e in j.history_tail(2)],
+                         [("1.0", "2.0"), ("2.0", "1.0")])
+
+    def test_verify(self):
+        os.mkdir("j/release/2.0")
+        os.mkdir("j/release/2.0/bin")
+        open("j/release/2.0/bin/foo", "w").write("foo")
+        open("j/release/2.0/bar", "w").write("bar")
+        self.jungle("manifest", "2.0")
+        self.assertEqual(self.jungle("verify", "2.0"), "")
+        self.assertEqual(self.jungle2("verify", opts=["--quick"], a=["2.0"]), "")
+        open("j/release/2.0/bin/foo", "w").write("oof")
+        os.remove("j/release/2.0/bar")
+        try:
+            self.jungle("verify", "2.0")
+        except subprocess.CalledProcessError, e:
+            self.assertEqual(e.output.splitlines()[:2],
+                             ["bin/foo has changed content", "bar is missing"])
+        else:
+            self.fail("verify did not fail")
+
+    def test_verify_quick(self):
+        os.mkdir("j/release/2.0")
+        open("j/release/2.0/foo", "w").write("foo")
+        self.jungle("manifest", "2.0")
+        open("j/release/2.0/foo", "w").write("fooo")
+        self.assertRaises(subprocess.CalledProcessError, self.jungle2, "verify", opts=["--quick"], a=["2.0"])
+
+    def test_set_verify(self):
+        os.mkdir("j/release/2.0")
+        open("j/release/2.0/foo", "w").write("foo")
+        self.jungle("manifest", "2.0")
+        mode = os.stat("j/release/2.0/foo").st_mode
+        os.chmod("j/release/2.0/foo", 0700)
+        self.assertRaises(subprocess.CalledProcessError, self.jungle2, "set", opts=["--verify"], a=["2.0"])
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+        os.chmod("j/release/2.0/foo", mode)
+        self.jungle2("set", opts=["--verify"], a=["2.0"])
+        self.assertEqual(os.readlink("j/current"), "release/2.0")
+
+    def hook(self, stage, name, script):
+        d = os.path.join("j/hooks", stage + ".d")
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        path = os.path.join(d, name)
+        open(path, "w").write("#!/bin/sh\n" + script)
+        os.chmod(path, 0755)
+
+    def test_hooks(self):
+        os.mkdir("j/release/2.0")
+        self.hook("pre-switch", "a", "echo $JUNGLE_FROM $JUNGLE_TO > pre\n")
+        self.hook("post-switch", "a", "sleep 1; readlink current > post-a\n")
+        self.hook("post-switch", "b", "sleep 1; echo $JUNGLE_TO > post-b\n")
+        started = time.time()
+        self.jungle("set", "2.0")
+        # the post-switch hooks run at the same time
+        self.assert_(time.time() - started < 1.9)
+        self.assertEqual(open("j/pre").read(), "1.0 2.0\n")
+        self.assertEqual(open("j/post-a").read(), "release/2.0\n")
+        self.assertEqual(open("j/post-b").read(), "2.0\n")
+
+    def test_pre_switch_hook_fails(self):
+        os.mkdir("j/release/2.0")
+        self.hook("pre-switch", "a", "exit 1\n")
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "set", "2.0")
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+
+    def test_hook_timeout(self):
+        os.mkdir("j/release/2.0")
+        self.hook("pre-switch", "a", "sleep 10\n")
+        started = time.time()
+        self.assertRaises(subprocess.CalledProcessError, subprocess.check_output,
+                          ["./jungle.py", "-t", "0.5", "set", "j", "2.0"])
+        self.assert_(time.time() - started < 5)
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+
+    def metrics(self, path):
+        metrics = {}
+        for line in open(path):
+            if not line.startswith("#"):
+                key, value = line.split()
+                name = key.split("{")[0]
+                command = key.partition('command="')[2].partition('"')[0]
+                metrics[(name, command)] = float(value)
+        return metrics
+
+    def test_metrics(self):
+        os.mkdir("j/release/2.0")
+        os.mkdir("j/release/3.0")
+        subprocess.check_output(["./jungle.py", "--metrics-file", "j/metrics.prom", "set", "j", "2.0"])
+        m = self.metrics("j/metrics.prom")
+        self.assertEqual(m[("jungle_operation_success", "set")], 1)
+        self.assertEqual(m[("jungle_versions", "")], 3)
+        self.assertEqual(m[("jungle_head_gap", "")], 1)
+        self.assert_(abs(m[("jungle_last_switch_timestamp_seconds", "")] - time.time()) < 60)
+        self.assert_(not os.path.exists("j/metrics.prom.new"))
+        subprocess.check_output(["./jungle.py", "--metrics-file", "j/metrics.prom", "status", "j"])
+        m = self.metrics("j/metrics.prom")
+        # the sample for set is carried forward
+        self.assert_(("jungle_operation_duration_seconds", "set") in m)
+        self.assert_(("jungle_operation_duration_seconds", "status") in m)
+        self.assertEqual(len(open("j/metrics.prom").read().split("# TYPE jungle_versions ")), 2)
+
+    def test_metrics_parents(self):
+        os.mkdir("k")
+        try:
+            os.mkdir("k/release")
+            os.mkdir("k/release/1.0")
+            subprocess.check_output(["./jungle.py", "init", "k"])
+            for parent in ("j", "k"):
+                subprocess.check_output(["./jungle.py", "--metrics-file", "j/metrics.prom", "status", parent])
+            text = open("j/metrics.prom").read()
+            for parent in ("j", "k"):
+                self.assert_('jungle_operation_duration_seconds{command="status",parent="%s"}'
+                             % os.path.abspath(parent) in text)
+        finally:
+            shutil.rmtree("k")
+
+    def test_metrics_archive_small(self):
+        # an empty release frees nothing, but its archive takes a block
+        os.mkdir("j/release/2.0")
+        self.jungle("upgrade")
+        subprocess.check_output(["./jungle.py", "--metrics-file", "j/metrics.prom", "prune", "--iterations", "1", "--archive", "j"])
+        m = self.metrics("j/metrics.prom")
+        self.assertEqual(m[("jungle_reclaimed_bytes", "prune")], 0)
+
+    def test_metrics_reclaimed(self):
+        os.mkdir("j/release/2.0")
+        os.mkdir("j/release/3.0")
+        os.mkdir("j/release/1.0/sub")
+        open("j/release/1.0/sub/foo", "w").write("x" * 10000)
+        os.link("j/release/1.0/sub/foo", "j/release/1.0/foo")
+        open("j/release/1.0/bar", "w").write("x" * 10000)
+        os.link("j/release/1.0/bar", "j/bar")
+        expected = os.stat("j/release/1.0/sub/foo").st_blocks * 512
+        self.jungle("upgrade")
+        subprocess.check_output(["./jungle.py", "--metrics-file", "j/metrics.prom", "prune", "--iterations", "2", "j"])
+        m = self.metrics("j/metrics.prom")
+        self.assertEqual(m[("jungle_versions", "")], 2)
+        # directories are not counted, nor is bar which is still linked
+        self.assertEqual(m[("jungle_reclaimed_bytes", "prune")], expected)
+
+    def test_promote(self):
+        os.mkdir("j/release/2.0")
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "promote")
+        self.jungle("stage-next", "2.0")
+        self.assertEqual(os.readlink("j/next"), "release/2.0")
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+        self.assertEqual(self.jungle("promote"), "2.0\n")
+        self.assertEqual(os.readlink("j/current"), "release/2.0")
+        self.assertEqual(os.readlink("j/next"), "release/1.0")
+        self.assertEqual(os.readlink("j/previous"), "release/1.0")
+        self.assertEqual(self.jungle("promote"), "1.0\n")
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+
+    def test_prune_after_promote(self):
+        for v in ("2.0", "3.0", "4.0"):
+            os.mkdir("j/release/" + v)
+        self.jungle("stage-next", "4.0")
+        self.jungle("promote")
+        self.assertEqual(os.readlink("j/next"), "release/1.0")
+        now = time.time()
+        for v in ("1.0", "2.0"):
+            os.utime("j/release/" + v, (now, now - 20*24*3600))
+        self.jungle2("prune", opts=["--age", "10"])
+        self.assert_(os.path.exists("j/release/1.0"))
+        self.assert_(not os.path.exists("j/release/2.0"))
+        self.jungle2("prune", opts=["--iterations", "1", "--archive"])
+        self.assertEqual(sorted(os.listdir("j/release")), ["1.0", "4.0"])
+        self.assertEqual(self.jungle("archived"), "3.0\n")
+
+    def test_prune_keeps_previous(self):
+        for v in ("2.0", "3.0", "4.0"):
+            os.mkdir("j/release/" + v)
+        self.jungle("stage-next", "3.0")
+        self.jungle("promote")
+        self.jungle("stage-next", "4.0")
+        self.assertEqual(os.readlink("j/previous"), "release/1.0")
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "delete", "1.0")
+        self.jungle2("prune", opts=["--iterations", "1"])
+        self.assertEqual(sorted(os.listdir("j/release")), ["1.0", "3.0", "4.0"])
+        self.assert_(os.path.isdir("j/previous"))
+
+    def test_promote_next_current(self):
+        os.mkdir("j/release/2.0")
+        self.jungle("stage-next", "2.0")
+        self.jungle("set", "2.0")
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "promote")
+        self.assertEqual(len(self.jungle("history").splitlines()), 2)
+
+    def test_stage_next_current(self):
+        self.assertRaises(subprocess.CalledProcessError, self.jungle, "stage-next", "1.0")
+        self.assert_(not os.path.lexists("j/next"))
+
+    def test_hook_timeout_kills_children(self):
+        os.mkdir("j/release/2.0")
+        self.hook("pre-switch", "a", "sleep 7\necho done\n")
+        started = time.time()
+        # stderr is piped, so this waits for anything still holding it
+        p = subprocess.Popen(["./jungle.py", "-t", "0.5", "set", "j", "2.0"],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        self.assert_(time.time() - started < 5)
+        self.assertNotEqual(p.returncode, 0)
+        self.assert_("done" not in err)
+        self.assertEqual(os.readlink("j/current"), "release/1.0")
+
 if __name__ == '__main__':
     main()
                          